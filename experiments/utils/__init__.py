@@ -1,5 +1,7 @@
 from .utils import (
     get_layer_sizes,
+    get_param_count,
+    get_flops,
     get_parameter_count_and_flops,
     get_module_name,
     format_plt,
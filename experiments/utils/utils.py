@@ -1,6 +1,8 @@
 from datetime import datetime
 import os
 import csv
+import atexit
+from functools import lru_cache
 import torch
 from thop import profile
 import matplotlib.pyplot as plt
@@ -8,6 +10,9 @@ import matplotlib.pyplot as plt
 
 current_dir = os.path.dirname(__file__)
 
+# Open CSV files and their writers, kept open across calls and closed at exit
+_csv_writers = {}
+
 
 def now():
     return datetime.now().strftime("%Y%m%dT%H%M%S")
@@ -21,19 +26,58 @@ def get_module_name(model, module):
 
 
 def get_layer_sizes(model):
-    summary = []
-    for m, _ in model.get_pruning_graph():
-        summary.append(m.weight.shape[0])
-    return str(summary).replace(", ", "-").replace("[", "").replace("]", "")
+    return _format_layer_sizes(tuple(m.weight.shape[0] for m, _ in model.get_pruning_graph()))
+
+
+@lru_cache(maxsize=32)
+def _format_layer_sizes(sizes):
+    return "-".join(map(str, sizes))
+
+
+def get_param_count(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def get_flops(model, input_size, device):
+    # Returns the FLOPs for a *single* sample. Logs written before this function
+    # profiled a batch of two samples, so their `flops` column is twice as large
+    # and should not be compared directly with newer results.
+    # Profile in eval mode, so that a single sample is enough also with BatchNorm
+    training = model.training
+    model.eval()
+    try:
+        x = torch.randn((1,) + tuple(input_size), device=device)
+        macs, _ = profile(model, inputs=(x,))
+    finally:
+        model.train(training)
+    return 2 * macs
 
 
 def get_parameter_count_and_flops(model, input_size, device):
-    # Notice that, because of BatchNorm, the samples dim must be >= 2
-    x = torch.randn((2,) + tuple(input_size))
-    x = x.to(device)
-    macs, params = profile(model, inputs=(x,))
-    print(f"Model with {params} params and {2*macs} flops")
-    return 2 * macs, params
+    flops, params = get_flops(model, input_size, device), get_param_count(model)
+    print(f"Model with {params} params and {flops} flops")
+    return flops, params
+
+
+def _write_csv_row(filename, row):
+    if filename not in _csv_writers:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        csvfile = open(filename, "a", newline="")
+        writer = csv.DictWriter(csvfile, fieldnames=row.keys())
+        if csvfile.tell() == 0:
+            writer.writeheader()
+        _csv_writers[filename] = (csvfile, writer)
+    csvfile, writer = _csv_writers[filename]
+    writer.writerow(row)
+    # Flush every row, so that results are not lost if the experiment is interrupted
+    csvfile.flush()
+
+
+@atexit.register
+def _close_csv_writers():
+    for csvfile, _ in _csv_writers.values():
+        csvfile.close()
+    _csv_writers.clear()
 
 
 class Logger:
@@ -48,30 +92,26 @@ class Logger:
     def log(self, model, test_loss, test_acc, test_loss_pp, test_acc_pp, prune_time):
         flops, n_params = get_parameter_count_and_flops(model, self.input_size, self.device)
         layers = get_layer_sizes(model)
-        with open(self.filename, "a", newline="") as csvfile:
-            dict = {
-                "timestamp": self.now,
-                "epoch": 0,
-                "train_acc": 0,
-                "test_acc": test_acc,
-                "test_acc_pp": test_acc_pp,
-                "train_loss": 0,
-                "test_loss": test_loss,
-                "test_loss_pp": test_loss_pp,
-                "n_params": n_params,
-                "flops": flops,
-                "n_params_full": self.n_params_original,
-                "flops_full": self.n_params_original,
-                "layers": layers,
-                "train_time": 0.,
-                "prune_time": prune_time,
-                "experiment": self.args.log,
-                "pr": self.args.pr
-            }
-            writer = csv.DictWriter(csvfile, fieldnames=dict.keys())
-            if csvfile.tell() == 0:
-                writer.writeheader()
-            writer.writerow(dict)
+        dict = {
+            "timestamp": self.now,
+            "epoch": 0,
+            "train_acc": 0,
+            "test_acc": test_acc,
+            "test_acc_pp": test_acc_pp,
+            "train_loss": 0,
+            "test_loss": test_loss,
+            "test_loss_pp": test_loss_pp,
+            "n_params": n_params,
+            "flops": flops,
+            "n_params_full": self.n_params_original,
+            "flops_full": self.n_params_original,
+            "layers": layers,
+            "train_time": 0.,
+            "prune_time": prune_time,
+            "experiment": self.args.log,
+            "pr": self.args.pr
+        }
+        _write_csv_row(self.filename, dict)
 
 
 COLORS = ["orange",
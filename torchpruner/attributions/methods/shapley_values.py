@@ -9,10 +9,11 @@ class ShapleyAttributionMetric(_AttributionMetric):
     Compute attributions as approximate Shapley values using sampling.
     """
 
-    def __init__(self, *args, sv_samples=5, **kwargs):
+    def __init__(self, *args, sv_samples=5, sv_batch_size=128, **kwargs):
         super().__init__(*args, **kwargs)
         self.samples = sv_samples
-        self.mask_indices = []
+        self.batch_size = sv_batch_size
+        self.masks = None
 
     def run(self, module, sv_samples=None, **kwargs):
         module = super().run(module, **kwargs)
@@ -31,10 +32,8 @@ class ShapleyAttributionMetric(_AttributionMetric):
         that provides a `forward_partial` function. This is significantly faster
         than run_module(), as it only runs the forward pass on the necessary modules.
         """
-        d = len(self.data_gen.dataset)
-        sv = None
+        sv = []
         permutations = None
-        c = 0
 
         with torch.no_grad():
             for idx, (x, y) in enumerate(self.data_gen):
@@ -44,24 +43,17 @@ class ShapleyAttributionMetric(_AttributionMetric):
                 n = original_z.shape[1]  # prunable dimension
                 if permutations is None:
                     # Keep the same permutations for all batches
-                    permutations = [np.random.permutation(n) for _ in range(sv_samples)]
-                if sv is None:
-                    sv = np.zeros((d, n))
+                    permutations = self._sample_permutations(sv_samples, n)
+                    masks = self._permutation_masks(permutations)
 
-                for j in range(sv_samples):
-                    loss = original_loss.detach().clone()
-                    z = original_z.clone().detach()
+                losses = []
+                for chunk in self._split_masks(masks, len(x)):
+                    z = self._apply_masks(original_z.unsqueeze(0), chunk)
+                    _, loss = self.run_forward_partial(z, y_true=self._repeat(y, len(chunk)), from_module=module)
+                    losses.append(loss.reshape(len(chunk), -1))
+                sv.append(self._marginal_contributions(permutations, original_loss, torch.cat(losses, 0)))
 
-                    for i in permutations[j]:
-                        z.index_fill_(1, torch.tensor(np.array([i])).long().to(self.device), 0.0)
-                        _, new_loss = self.run_forward_partial(z, y_true=y, from_module=module)
-                        delta = new_loss - loss
-                        n = delta.shape[0]
-                        sv[c:c+n, i] += (delta / sv_samples).squeeze().detach().cpu().numpy()
-                        loss = new_loss
-                c += n
-
-            return self.aggregate_over_samples(sv)
+            return self.aggregate_over_samples(np.concatenate(sv, 0))
 
     def run_module(self, module, samples):
         """
@@ -69,31 +61,99 @@ class ShapleyAttributionMetric(_AttributionMetric):
         No further changes to the model are necessary but this can be quite slow.
         See run_module_with_partial() for a faster version that uses partial evaluation.
         """
+        sv = []
+        permutations = None
+
         with torch.no_grad():
-            self.mask_indices = []
+            self.masks = None
             handle = module.register_forward_hook(self._forward_hook())
-            original_loss = self.run_all_forward()
-            n = module._tp_prune_dim  # output dimension
-            sv = np.zeros((original_loss.shape[0], n))
-
-            for j in range(samples):
-                # print (f"Sample {j}")
-                self.mask_indices = []
-                loss = original_loss.detach().clone()
-                for i in np.random.permutation(n):
-                    self.mask_indices.append(i)
-                    new_loss = self.run_all_forward()
-                    sv[:, i] += ((new_loss - loss) / samples).squeeze().detach().cpu().numpy()
-                    loss = new_loss
+            self.set_deterministic()
+            for idx, (x, y) in enumerate(self.data_gen):
+                x, y = x.to(self.device), y.to(self.device)
+                self.masks = None
+                original_loss = self.criterion(self.model(x), y, reduction="none")
+                n = module._tp_prune_dim  # output dimension
+                if permutations is None:
+                    # Keep the same permutations for all batches
+                    permutations = self._sample_permutations(samples, n)
+                    masks = self._permutation_masks(permutations)
+
+                losses = []
+                for chunk in self._split_masks(masks, len(x)):
+                    self.masks = chunk
+                    output = self.model(self._repeat(x, len(chunk)))
+                    loss = self.criterion(output, self._repeat(y, len(chunk)), reduction="none")
+                    losses.append(loss.reshape(len(chunk), -1))
+                sv.append(self._marginal_contributions(permutations, original_loss, torch.cat(losses, 0)))
+            self.restore_deterministic()
 
+            self.masks = None
             handle.remove()
-            return self.aggregate_over_samples(sv)
+            return self.aggregate_over_samples(np.concatenate(sv, 0))
+
+    def _sample_permutations(self, samples, n):
+        """
+        Sample `samples` random permutations of the `n` prunable units at once.
+        :return: LongTensor of shape (samples, n)
+        """
+        return torch.argsort(torch.rand(samples, n, device=self.device), dim=1)
+
+    def _split_masks(self, masks, batch):
+        """
+        Split the masks in chunks, such that each forward pass evaluates at most `batch_size`
+        masked examples. A single mask per chunk is used when the data batch is larger than that.
+        """
+        return masks.split(max(1, self.batch_size // batch))
+
+    @staticmethod
+    def _permutation_masks(permutations):
+        """
+        For each permutation, build the masks obtained by removing its units one at a time.
+        Mask `k` of permutation `s` keeps only the units not among the first `k + 1` of the permutation.
+        :return: BoolTensor of shape (samples * n, n)
+        """
+        samples, n = permutations.shape
+        ranks = torch.argsort(permutations, dim=1)
+        steps = torch.arange(1, n + 1, device=permutations.device).view(1, n, 1)
+        return (ranks.unsqueeze(1) >= steps).view(samples * n, n)
+
+    @staticmethod
+    def _apply_masks(z, masks):
+        """
+        Apply each mask to the corresponding copy of the activation `z`, setting masked units to zero.
+        :param z: Tensor of shape (len(masks), batch, n, ...), or (1, batch, n, ...) to broadcast
+        :return: Tensor of shape (len(masks) * batch, n, ...)
+        """
+        masks = masks.view((len(masks), 1) + masks.shape[1:] + (1,) * (z.dim() - 3))
+        return (z * masks.to(z.dtype)).flatten(0, 1)
+
+    @staticmethod
+    def _repeat(t, times):
+        return t.repeat((times,) + (1,) * (t.dim() - 1))
+
+    @staticmethod
+    def _marginal_contributions(permutations, original_loss, losses):
+        """
+        Average over permutations the loss difference caused by removing each unit.
+        :param permutations: LongTensor of shape (samples, n)
+        :param original_loss: loss of the unmasked model, one value per example
+        :param losses: Tensor of shape (samples * n, batch), loss after each step of each permutation
+        :return: np.array of shape (batch, n)
+        """
+        samples, n = permutations.shape
+        losses = losses.view(samples, n, -1)
+        original_loss = original_loss.reshape(1, 1, -1).expand(samples, 1, losses.shape[-1])
+        losses = torch.cat((original_loss, losses), 1)
+        deltas = losses[:, 1:] - losses[:, :-1]
+        # deltas[s, k] is the contribution of unit permutations[s, k]
+        ranks = torch.argsort(permutations, dim=1).unsqueeze(-1).expand_as(deltas)
+        return deltas.gather(1, ranks).mean(0).t().detach().cpu().numpy()
 
     def _forward_hook(self):
         def _hook(module, _, output):
             module._tp_prune_dim = output.shape[1]
-            return output.index_fill_(
-                1, torch.tensor(self.mask_indices).long().to(self.device), 0.0,
-            )
+            if self.masks is None:
+                return output
+            return self._apply_masks(output.view((len(self.masks), -1) + output.shape[1:]), self.masks)
 
         return _hook
@@ -2,7 +2,6 @@ from unittest import TestCase
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import TensorDataset
 import torch.nn.functional as F
 
 
@@ -18,96 +17,117 @@ from torchpruner.attributions import (
 
 def max_model(device, version=1):
     # Make sure symmetric inputs are provided
-    x = np.array([[0, 1], [1, 0], [1, 2], [2, 1]])
-    y = np.array([[np.max(xi)] for xi in x])
-    x = torch.tensor(x).float().to(device)
-    y = torch.tensor(y).float().to(device)
+    x = torch.as_tensor([[0, 1], [1, 0], [1, 2], [2, 1]], dtype=torch.float32, device=device)
+    y = x.max(dim=1, keepdim=True).values
 
+    # Weights are given as (out_features, in_features), as stored by nn.Linear
+    w1 = [[-0.5, 0.5], [1.0, -1.0], [1.0, 1.0], [1.0, 1.0]]
     if version == 1:
         # Perfect solution
-        w1 = torch.tensor(
-            np.array([[-0.5, 1.0, 1.0, 1.0], [0.5, -1.0, 1.0, 1.0]])
-        ).float()
-        w2 = torch.tensor(np.array([[1], [0.5], [0.5], [0.0]])).float()
+        w2 = [[1.0, 0.5, 0.5, 0.0]]
     elif version == 2:
         # Perfect solution except unit (D) which has a non-zero outgoing edge
-        w1 = torch.tensor(
-            np.array([[-0.5, 1.0, 1.0, 1.0], [0.5, -1.0, 1.0, 1.0]])
-        ).float()
-        w2 = torch.tensor(np.array([[1], [0.5], [0.5,], [-0.1]])).float()
+        w2 = [[1.0, 0.5, 0.5, -0.1]]
 
-    linear1 = nn.Linear(2, 4, bias=False)
-    linear1.weight.data = torch.t(w1).to(device)
-    linear2 = nn.Linear(4, 2, bias=False)
-    linear2.weight.data = torch.t(w2).to(device)
-
-    model = nn.Sequential(linear1, nn.ReLU(), linear2).to(device)
+    model = _build_skeleton().to(device)
+    linear1, _, linear2 = model
+    linear1.weight.data.copy_(torch.tensor(w1, dtype=torch.float32, device=device))
+    linear2.weight.data.copy_(torch.tensor(w2, dtype=torch.float32, device=device))
     return x, y, model
 
 
+def _build_skeleton():
+    return nn.Sequential(nn.Linear(2, 4, bias=False), nn.ReLU(), nn.Linear(4, 1, bias=False))
+
+
+class _PartialSequential(nn.Sequential):
+    """
+    Sequential model providing `forward_partial`, as required by the fast Shapley values implementation
+    """
+
+    def forward_partial(self, x, to_module=None, from_module=None):
+        modules = list(self.children())
+        if from_module is not None:
+            modules = modules[modules.index(from_module) + 1:]
+        for module in modules:
+            x = module(x)
+            if module is to_module:
+                break
+        return x
+
+
+def _make_batches(x, y, batch_size=None):
+    # Metrics only iterate over (x, y) pairs, so a list of batches can replace a DataLoader.
+    # By default, the whole dataset is used as a single batch
+    batch_size = batch_size or len(x)
+    return [(x[i:i + batch_size], y[i:i + batch_size]) for i in range(0, len(x), batch_size)]
+
 
 class TestTorchPruner(TestCase):
-    def setUp(self):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    @classmethod
+    def setUpClass(cls):
+        cls.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # Build the max models only once, each test loads the weights into a fresh model
+        cls._x, cls._y, model = max_model(cls.device)
+        cls._sd_v1 = model.state_dict()
+        cls._sd_v2 = max_model(cls.device, version=2)[2].state_dict()
+
+    def max_model(self, version=1):
+        model = _build_skeleton().to(self.device)
+        model.load_state_dict(self._sd_v1 if version == 1 else self._sd_v2)
+        return self._x, self._y, model
 
     def tearDown(self):
         pass
 
     def test_max_model(self):
-        x, y, model = max_model(self.device)
-        y_pred = model(x)
-        np.testing.assert_array_almost_equal(
-            y.detach().cpu().numpy(), y_pred.detach().cpu().numpy()
-        )
+        x, y, model = self.max_model()
+        with torch.no_grad():
+            y_pred = model(x)
+        # Compare on device, with the same tolerance as assert_array_almost_equal
+        self.assertTrue(torch.allclose(y_pred, y, rtol=0, atol=1.5e-6))
 
     ##
     # def test_set_deterministic(self):
-    #     x, y, model = max_model(self.device)
-    #     datagen = torch.utils.data.DataLoader(
-    #         dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-    #     )
+    #     x, y, model = self.max_model()
+    #     datagen = _make_batches(x, y)
     #     self.assertFalse(torch.backends.cudnn.deterministic)
     #     a = APoZAttributionMetric(model, datagen, F.mse_loss, self.device)
     #     a.run(list(model.children())[0])
     #     self.assertTrue(torch.backends.cudnn.deterministic)
 
     def test_random(self):
-        x, y, model = max_model(self.device)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model()
+        datagen = _make_batches(x, y)
         a = RandomAttributionMetric(model, datagen, F.mse_loss, self.device)
 
-        attr = a.run(list(model.children())[0])
+        with torch.no_grad():
+            attr = a.run(list(model.children())[0])
         self.assertEqual(list(attr.shape), [4])
 
     def test_weight_norm(self):
-        x, y, model = max_model(self.device)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model()
+        datagen = _make_batches(x, y)
         a = WeightNormAttributionMetric(model, datagen, F.mse_loss, self.device)
 
-        attr = a.run(list(model.children())[0])
+        with torch.no_grad():
+            attr = a.run(list(model.children())[0])
         self.assertEqual(list(attr.shape), [4])
         np.testing.assert_array_almost_equal(attr, [1, 2, 2, 2])
 
     def test_apoz(self):
-        x, y, model = max_model(self.device)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model()
+        datagen = _make_batches(x, y)
         a = APoZAttributionMetric(model, datagen, F.mse_loss, self.device)
 
-        attr = a.run(list(model.children())[0])
+        with torch.no_grad():
+            attr = a.run(list(model.children())[0])
         self.assertEqual(list(attr.shape), [4])
         np.testing.assert_array_almost_equal(attr, [0.5, 0.5, 1, 1])
 
     def test_sensitivity(self):
-        x, y, model = max_model(self.device)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model()
+        datagen = _make_batches(x, y)
         a = SensitivityAttributionMetric(model, datagen, F.mse_loss, self.device)
 
         attr = a.run(list(model.children())[0])
@@ -115,10 +135,8 @@ class TestTorchPruner(TestCase):
         np.testing.assert_array_almost_equal(attr, [0.0, 0.0, 0.0, 0.0])
 
     def test_taylor(self):
-        x, y, model = max_model(self.device)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model()
+        datagen = _make_batches(x, y)
         a = TaylorAttributionMetric(model, datagen, F.mse_loss, self.device)
 
         attr = a.run(list(model.children())[0])
@@ -126,21 +144,37 @@ class TestTorchPruner(TestCase):
         np.testing.assert_array_almost_equal(attr, [0.0, 0.0, 0.0, 0.0])
 
     def test_sv(self):
-        x, y, model = max_model(self.device)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model()
+        datagen = _make_batches(x, y)
         a = ShapleyAttributionMetric(model, datagen, F.mse_loss, self.device, sv_samples=1000)
 
-        attr = a.run(list(model.children())[0])
+        with torch.no_grad():
+            attr = a.run(list(model.children())[0])
         self.assertEqual(list(attr.shape), [4])
         np.testing.assert_array_almost_equal(attr, [0.37, 0.37, 1.7, 0.], decimal=1)
 
+    def test_sv_with_partial(self):
+        x, y, model = self.max_model()
+        partial_model = _PartialSequential(*_build_skeleton()).to(self.device)
+        partial_model.load_state_dict(model.state_dict())
+        # Uneven batches, with chunks not aligned to the number of masks
+        datagen = _make_batches(x, y, batch_size=3)
+
+        torch.manual_seed(0)
+        a = ShapleyAttributionMetric(model, datagen, F.mse_loss, self.device, sv_samples=1000, sv_batch_size=5)
+        attr = a.run(list(model.children())[0])
+        torch.manual_seed(0)
+        a = ShapleyAttributionMetric(partial_model, datagen, F.mse_loss, self.device, sv_samples=1000, sv_batch_size=5)
+        attr_partial = a.run(list(partial_model.children())[0])
+
+        self.assertEqual(list(attr_partial.shape), [4])
+        np.testing.assert_array_almost_equal(attr_partial, attr)
+        np.testing.assert_array_almost_equal(attr_partial, [0.37, 0.37, 1.7, 0.], decimal=1)
+
     def test_sensitivity_2(self):
-        x, y, model = max_model(self.device, version=2)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model(version=2)
+        # Per-example gradients of the mean loss are scaled by the batch size
+        datagen = _make_batches(x, y, batch_size=1)
         a = SensitivityAttributionMetric(model, datagen, F.mse_loss, self.device)
 
         attr = a.run(list(model.children())[0])
@@ -151,10 +185,9 @@ class TestTorchPruner(TestCase):
         np.testing.assert_array_almost_equal(attr, [0.2, 0.1, 0.2, 0.04])
 
     def test_taylor_2(self):
-        x, y, model = max_model(self.device, version=2)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model(version=2)
+        # Per-example gradients of the mean loss are scaled by the batch size
+        datagen = _make_batches(x, y, batch_size=1)
         a = TaylorAttributionMetric(model, datagen, F.mse_loss, self.device)
 
         attr = a.run(list(model.children())[0])
@@ -162,10 +195,9 @@ class TestTorchPruner(TestCase):
         np.testing.assert_array_almost_equal(attr, [0.1, 0.1, 0.5, 0.1])
 
     def test_taylor_2_signed(self):
-        x, y, model = max_model(self.device, version=2)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model(version=2)
+        # Per-example gradients of the mean loss are scaled by the batch size
+        datagen = _make_batches(x, y, batch_size=1)
         a = TaylorAttributionMetric(
             model, datagen, F.mse_loss, self.device, signed=True
         )
@@ -179,10 +211,8 @@ class TestTorchPruner(TestCase):
         Given a Linear of Conv layer, we want to compute attributions *after* any BatchNorm
         or activation layers that might follow.
         """
-        x, y, _ = max_model(self.device, version=2)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, _ = self.max_model(version=2)
+        datagen = _make_batches(x, y)
         # Define model with BatchNorm and ReLU
         model = nn.Sequential(nn.Linear(3, 2), nn.BatchNorm1d(2), nn.ReLU(), nn.Linear(2, 1)).to(
             self.device
@@ -201,10 +231,8 @@ class TestTorchPruner(TestCase):
             self.assertEqual(eval_module, list(model.children())[0])
 
     def test_run_all_with_find_best_evaluation_module(self):
-        x, y, model = max_model(self.device)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model()
+        datagen = _make_batches(x, y)
 
         for A in [TaylorAttributionMetric, SensitivityAttributionMetric,
                   APoZAttributionMetric, WeightNormAttributionMetric]:
@@ -216,10 +244,8 @@ class TestTorchPruner(TestCase):
             np.testing.assert_array_almost_equal(attr, attr_best)
 
     def test_run_all_with_find_best_evaluation_module_2(self):
-        x, y, model = max_model(self.device)
-        datagen = torch.utils.data.DataLoader(
-            dataset=TensorDataset(x, y), batch_size=1, shuffle=False,
-        )
+        x, y, model = self.max_model()
+        datagen = _make_batches(x, y)
 
         for A in [TaylorAttributionMetric, SensitivityAttributionMetric,
                   APoZAttributionMetric, WeightNormAttributionMetric, RandomAttributionMetric, ShapleyAttributionMetric]:
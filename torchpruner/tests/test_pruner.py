@@ -17,8 +17,9 @@ def simple_model(device):
 
 
 class TestTorchPruner(TestCase):
-    def setUp(self):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    @classmethod
+    def setUpClass(cls):
+        cls.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     def tearDown(self):
         pass